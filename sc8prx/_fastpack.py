@@ -0,0 +1,43 @@
+# Copyright 2015-2023 D.G. MacCarthy <https://dmaccarthy.github.io/sc8pr>
+#
+# This file is part of "sc8prx".
+#
+# "sc8prx" is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# "sc8prx" is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with "sc8prx".  If not, see <http://www.gnu.org/licenses/>.
+
+"Pack RGBA (or strided RGB) pixel arrays into contiguous RGB buffers, using numba when available"
+
+import numpy
+
+try: from numba import njit
+except ImportError: njit = None
+
+if njit:
+
+    @njit(cache=True)
+    def rgba_to_rgb(src, dst):
+        "Copy the first three channels of src into dst"
+        h, w = dst.shape[0], dst.shape[1]
+        for y in range(h):
+            for x in range(w):
+                dst[y, x, 0] = src[y, x, 0]
+                dst[y, x, 1] = src[y, x, 1]
+                dst[y, x, 2] = src[y, x, 2]
+        return dst
+
+else:
+
+    def rgba_to_rgb(src, dst):
+        "Copy the first three channels of src into dst"
+        numpy.copyto(dst, src[:, :, :3])
+        return dst
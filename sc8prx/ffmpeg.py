@@ -18,14 +18,22 @@
 "FFmpeg encoding and decoding using imageio/imageio-ffmpeg"
 
 import os, numpy, imageio
+from subprocess import Popen, PIPE, DEVNULL
+from threading import Thread
+from queue import Queue, Empty
+from imageio_ffmpeg import get_ffmpeg_exe, read_frames
 from json import dumps
 from zipfile import ZipFile, ZIP_DEFLATED
 from sc8pr import Image, BaseSprite
 from sc8pr.util import surface
 from sc8pr.sprite import CostumeImage, Sprite
 from sc8pr.misc.video import Video, _open_list
+from sc8prx._fastpack import rgba_to_rgb
 from pygame.surfarray import pixels3d
+from pygame.image import frombuffer
 from pygame.pixelcopy import make_surface
+from pygame.transform import smoothscale
+from pygame import Surface, SRCALPHA
 
 # try: v3 = imageio.v3
 # except: v3 = None
@@ -39,29 +47,149 @@ class _FF:
     def __enter__(self): return self
     
     def close(self, *args):
-        self._io.close()
+        if self._io is not None: self._io.close()
         if self in _open_list: _open_list.remove(self)
 
     __exit__ = close
 
 
+class _Pipe:
+    "Read raw frames from an FFmpeg subprocess directly into numpy arrays"
+
+    def __init__(self, src, size=None, pixelformat="rgb24", input_params=None, output_params=None, reuse=False):
+        if pixelformat not in ("rgb24", "rgba"):
+            raise ValueError("Unsupported pixelformat: {}".format(pixelformat))
+        self._reuse = reuse
+        src = str(src)
+        ip = list(input_params or [])
+        op = ["-pix_fmt", pixelformat] + list(output_params or [])
+        if size: op += ["-s", size if type(size) is str else "{}x{}".format(*size)]
+        gen = read_frames(src, pixelformat, input_params=ip, output_params=op)
+        try: self._meta = meta = next(gen)
+        finally: gen.close()
+        meta.setdefault("nframes", float("inf"))
+        w, h = meta["size"]
+        self._shape = h, w, 4 if pixelformat == "rgba" else 3
+        cmd = [get_ffmpeg_exe(), "-v", "error"] + ip + ["-i", src, "-f", "rawvideo"] + op + ["-"]
+        self._proc = Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE, bufsize=0)
+        self._log = []
+        self._logger = Thread(target=self._catch, daemon=True)
+        self._logger.start()
+
+    def _catch(self):
+        "Drain FFmpeg's stderr so the pipe cannot fill up and stall the decoder"
+        for line in self._proc.stderr:
+            self._log.append(line.decode(errors="replace"))
+
+    def _error(self, msg):
+        self._logger.join(1)
+        log = "".join(self._log).strip()
+        return IOError(msg + ("\n\nFFMPEG STDERR:\n" + log if log else ""))
+
+    def get_meta_data(self): return self._meta
+
+    def __iter__(self):
+        "Read frames into numpy arrays with no intermediate bytes objects"
+        read = self._proc.stdout.readinto
+        shape = self._shape
+        n = shape[0] * shape[1] * shape[2]
+        frame = numpy.empty(shape, numpy.uint8) if self._reuse else None
+        while True:
+            data = numpy.empty(shape, numpy.uint8) if frame is None else frame
+            buf = memoryview(data).cast("B")
+            i = 0
+            while i < n:
+                k = read(buf[i:])
+                if not k:
+                    if i: raise self._error("FFmpeg ended before a full frame could be read")
+                    if self._proc.wait(): raise self._error("FFmpeg exited with an error")
+                    return
+                i += k
+            yield data
+
+    def close(self):
+        p = self._proc
+        p.stdout.close()
+        if p.poll() is None: p.terminate()
+        p.wait()
+
+
+class _NvDec:
+    "Decode frames on an NVIDIA GPU using PyNvCodec (Video Processing Framework)"
+
+    def __init__(self, src, gpu_id=0, reuse=False):
+        import PyNvCodec as nvc
+        self._reuse = reuse
+        self._dec = dec = nvc.PyNvDecoder(str(src), gpu_id)
+        w, h = dec.Width(), dec.Height()
+        cs, cr = dec.ColorSpace(), dec.ColorRange()
+        if cs == nvc.ColorSpace.UNSPEC: cs = nvc.ColorSpace.BT_601
+        if cr == nvc.ColorRange.UDEF: cr = nvc.ColorRange.MPEG
+        self._cc = nvc.ColorspaceConversionContext(cs, cr)
+        self._cvt = nvc.PySurfaceConverter(w, h, dec.Format(), nvc.PixelFormat.RGB, gpu_id)
+        self._dwn = nvc.PySurfaceDownloader(w, h, nvc.PixelFormat.RGB, gpu_id)
+        fps, n = dec.Framerate(), dec.Numframes()
+        self._meta = {"size": (w, h), "fps": fps, "nframes": n if n else float("inf"),
+            "duration": n / fps if n and fps else 0, "codec": "nvdec"}
+        self._shape = h, w, 3
+
+    def get_meta_data(self): return self._meta
+
+    def __iter__(self):
+        "Decode and download frames into numpy arrays"
+        shape = self._shape
+        frame = numpy.empty(shape, numpy.uint8) if self._reuse else None
+        while True:
+            srf = self._dec.DecodeSingleSurface()
+            if srf.Empty(): return
+            rgb = self._cvt.Execute(srf, self._cc)
+            data = numpy.empty(shape, numpy.uint8) if frame is None else frame
+            if not self._dwn.DownloadSingleSurface(rgb, data): return
+            yield data
+
+    def close(self): self._dec = self._cvt = self._dwn = None
+
+
 class Reader(_FF):
     "Read images directly from a media file using imageio/FFmpeg"
 
     read_alpha = None
 
-    def __init__(self, src, **kwargs):
-        _open_list.append(self)
-        self._io = imageio.get_reader(src, **kwargs)
-        self._iter = iter(self._io)
+    def __init__(self, src, fast=False, backend=None, **kwargs):
+        if backend == "nvdec": io = _NvDec
+        elif backend is None: io = _Pipe if fast else imageio.get_reader
+        else: raise ValueError("unknown backend: {}".format(backend))
+        self._io = io(src, **kwargs)
+        self._seek = io is imageio.get_reader
+        self._index = 0
+        self._iter = self._frames() if self._seek else iter(self._io)
         self._meta = self._io.get_meta_data()
+        _open_list.append(self)
 
     @property
     def meta(self): return self._meta
+
+    def _frames(self):
+        "Generate frames from the current index, allowing imageio to seek"
+        get = self._io.get_data
+        n = self._io.get_length()
+        try:
+            while self._index < n:
+                data = get(self._index)
+                self._index += 1
+                yield data
+        except (IndexError, StopIteration): pass
     
     def __next__(self):
         "Return the next frame as an Image instance"
-        srf = make_surface(numpy.swapaxes(next(self._iter), 0, 1))
+        data = next(self._iter)
+        c = data.shape[2] if data.ndim == 3 and data.dtype == numpy.uint8 else 0
+        if c == 4 and self.read_alpha is False:
+            data = rgba_to_rgb(data, numpy.empty(data.shape[:2] + (3,), numpy.uint8))
+            c = 3
+        if c in (3, 4) and data.flags.c_contiguous:
+            srf = frombuffer(data, data.shape[1::-1], "RGBA" if c == 4 else "RGB")
+        else: srf = make_surface(numpy.swapaxes(data, 0, 1))
         return Image(surface(srf, self.read_alpha))
 
     def __iter__(self):
@@ -71,6 +199,7 @@ class Reader(_FF):
         except StopIteration: pass
 
     def read(self, n=None):
+        "Generate up to n frames (or all remaining frames) as Image instances"
         try:
             while n is None or n > 0:
                 img = next(self)
@@ -79,12 +208,13 @@ class Reader(_FF):
         except StopIteration: pass
 
     def skip(self, n):
-        "Read and discard n frames"
-        while n:
-            try:
-                next(self._iter)
-                n -= 1
-            except: n = 0
+        "Read and discard n frames, or seek past them if possible"
+        if n > 0 and self._seek:
+            self._index += n
+            self._iter = self._frames()
+            return self
+        it = self._iter
+        while n and next(it, None) is not None: n -= 1
         return self
 
     def estimateFrames(self):
@@ -98,76 +228,175 @@ class Reader(_FF):
         return n
 
     @staticmethod
-    def decode(mfile, zfile, start=0, frames=None, interval=1, mode="x", alpha=False, compression=ZIP_DEFLATED, **kwargs):
+    def decode(mfile, zfile, start=0, frames=None, interval=1, mode="x", alpha=False, compression=ZIP_DEFLATED, compresslevel=None, **kwargs):
         "Decode frames from a movie to a zip file containing raw data"
-        with Video(zfile, mode=mode, compression=compression) as vid:
+        if kwargs.get("fast") or kwargs.get("backend"): kwargs.setdefault("reuse", True)
+        with Video(zfile, mode=mode, compression=compression, compresslevel=compresslevel) as vid:
             with Reader(mfile, **kwargs) as ffr:
                 ffr.read_alpha = alpha
                 meta = ffr.meta
                 if meta.get("fps") and interval > 1: meta["fps"] /= interval
-                if start: ffr.read(start)
+                if start: ffr.skip(start)
                 i = 0
-                try:
-                    while True:
-                        img = next(ffr)
-                        vid += img
-                        i += 1
-                        if i == frames: break
-                except StopIteration: pass
+                for img in ffr.read(frames):
+                    vid += img
+                    i += 1
                 meta["nframes"] = i
 
 
+class _Pump(Thread):
+    "Feed frames to an imageio writer from a background thread"
+
+    def __init__(self, io, n):
+        super().__init__(daemon=True)
+        self._io = io
+        self._queue = Queue(n)
+        self._free = Queue()
+        self._owned = set()
+        self.error = None
+        self.start()
+
+    def run(self):
+        q = self._queue
+        while True:
+            data = q.get()
+            if data is None: break
+            if self.error is None:
+                try: self._io.append_data(data)
+                except Exception as e: self.error = e
+            if id(data) in self._owned: self._free.put(data)
+
+    def buffer(self, shape):
+        "Return an array owned by the pump that is not waiting in the queue"
+        try:
+            buf = self._free.get_nowait()
+            if buf.shape == shape: return buf
+            self._owned.discard(id(buf))
+        except Empty: pass
+        buf = numpy.empty(shape, numpy.uint8)
+        self._owned.add(id(buf))
+        return buf
+
+    def put(self, data):
+        if self.error: raise self.error
+        self._queue.put(data)
+
+    def close(self):
+        self._queue.put(None)
+        self.join()
+        if self.error: raise self.error
+
+
 class Writer(_FF):
     "Write graphics directly to media file using imageio/FFmpeg"
 
-    def __init__(self, fn, fps=30, size=None, **kwargs):
+    def __init__(self, fn, fps=30, size=None, queue=0, **kwargs):
         self._size = size
-        self._io = imageio.get_writer(fn, fps=fps, **kwargs)
+        self._queue = queue
+        self._args = fn, fps, kwargs
+        self._io = self._pump = self._append = self._src = self._scaled = self._rgb = None
         _open_list.append(self)
 
+    def close(self, *args):
+        try:
+            if self._pump: self._pump.close()
+        finally: super().close()
+
+    __exit__ = close
+
+    def _input_size(self, size):
+        "Open the writer on the first frame; return the frame size that FFmpeg expects"
+        if self._io is None:
+            fn, fps, kwargs = self._args
+            if self._size is None: self._size = size
+            elif size != self._size:
+                mb = kwargs.get("macro_block_size", 16) or 1
+                scale = "scale={}:{}".format(*[-(-n // mb) * mb for n in self._size])
+                op = list(kwargs.get("output_params", []))
+                vf = [i + 1 for i, p in enumerate(op) if p in ("-vf", "-filter:v")]
+                if vf and vf[-1] < len(op): op[vf[-1]] += "," + scale
+                else: op += ["-vf", scale]
+                kwargs = dict(kwargs, macro_block_size=1, output_params=op)
+            self._io = imageio.get_writer(fn, fps=fps, **kwargs)
+            if self._queue: self._pump = _Pump(self._io, self._queue)
+            self._append = self._pump.put if self._pump else self._io.append_data
+            self._src = size
+        return self._src
+
+    def _scale(self, srf):
+        "Resize a frame into a surface that is reused for the whole stream"
+        fmt = srf.get_bitsize(), srf.get_masks()
+        buf = self._scaled
+        if buf is None or buf[0] != fmt:
+            buf = self._scaled = fmt, Surface(self._src, srf.get_flags() & SRCALPHA, *fmt)
+        return smoothscale(srf, self._src, buf[1])
+
+    def _pack(self, data):
+        "Pack RGBA or strided RGB pixels into a reusable contiguous RGB buffer"
+        shape = data.shape[:2] + (3,)
+        if self._pump: return rgba_to_rgb(data, self._pump.buffer(shape))
+        buf = self._rgb
+        if buf is None or buf.shape != shape:
+            buf = self._rgb = numpy.empty(shape, numpy.uint8)
+        return rgba_to_rgb(data, buf)
+
     def write(self, img):
-        "Write one frame (surface) to the video file, resizing if necessary"
+        """Write one frame (surface) to the video file, resizing if necessary;
+        FFmpeg scales from the first frame's size, so later frames of another
+        size are resampled to that size first and then again by FFmpeg"""
         if not isinstance(img, Image): img = Image(img)
-        if self._size is None: self._size = img.size
-        elif img.size != self._size: img.config(size=self._size)
-        data = numpy.swapaxes(pixels3d(img.image), 0, 1)
-        self._io.append_data(data)
+        srf = img.image
+        if srf.get_size() != self._input_size(srf.get_size()): srf = self._scale(srf)
+        data = numpy.swapaxes(pixels3d(srf), 0, 1)
+        if self._pump or not data.flags.c_contiguous: data = self._pack(data)
+        self._append(data)
         return self
 
     __iadd__ = write
 
     def writePIL(self, img):
         "Write a PIL image to the video file, resizing if necessary"
-        if self._size is None: self._size = img.size
-        elif img.size != self._size: img = img.resize(self._size)
-        self._io.append_data(numpy.array(img))
+        size = self._input_size(img.size)
+        if img.size != size: img = img.resize(size)
+        self._append(numpy.asarray(img))
         return self
 
     def concat(self, src, start=0, frames=None):
         "Concatenate frames from a movie file"
-        with Reader(src, size=self._size).skip(start) as src:
-            try:
-                while frames is None or frames:
-                    self.write(next(src))
-                    if frames: frames -= 1
-            except StopIteration: pass
+        with Reader(src, size=self._src or self._size).skip(start) as src:
+            for img in src.read(frames): self.write(img)
         return self
 
     def concat_zip(self, src, start=0, frames=None):
         "Concatenate ZIP archive frames to the movie"
         with Video(src) as src:
-            clip = src[start:start+frames] if frames else src[start:]
-            for f in clip: self.write(f)
+            n = src._nframes
+            if start < 0: start += n
+            stop = start + frames if frames else n
+            if start >= stop: return self
+            size = tuple(src.meta["size"])
+            mode = src.meta["mode"]
+            raw = self._input_size(size) == size
+            shape = size[1], size[0], len(mode)
+            key = None
+            for i in range(start, stop):
+                k = src._actual(i)
+                if k is None: raise IndexError("out of range")
+                if k != key:
+                    key = k
+                    data = src.read(str(k))
+                    if raw: data = numpy.frombuffer(data, numpy.uint8).reshape(shape)
+                    else: data = frombuffer(data, size, mode)
+                if raw: self._append(data if shape[2] == 3 else self._pack(data))
+                else: self.write(data)
         return self
 
     @staticmethod
     def encode(zfile, mfile, fps=None, start=0, frames=None, **kwargs):
         "Encode frames from a ZIP archive using FFmpeg"
-        with Video(zfile) as vid:
-            if fps is None: fps = vid._meta.get("fps", 30)
-            with Writer(mfile, fps, **kwargs) as ffw:
-                seq = vid[start:start + frames] if frames else vid[start:] if start else vid
-                for img in seq: ffw.write(img)
+        if fps is None:
+            with Video(zfile) as vid: fps = vid._meta.get("fps", 30)
+        with Writer(mfile, fps, **kwargs) as ffw: ffw.concat_zip(zfile, start, frames)
 
 
 class Movie(CostumeImage):
@@ -21,11 +21,14 @@ import pygame, PIL.ImageGrab
 from sc8pr import Image
 from sc8pr.util import hasAlpha, surface
 
+try: _tobytes = pygame.image.tobytes
+except AttributeError: _tobytes = pygame.image.tostring
+
 def pil_image(srf, mode=None):
     "Convert surface to PIL.Image"
     srf = surface(srf)
     if mode is None: mode = "RGBA" if hasAlpha(srf) else "RGB"
-    return PIL.Image.frombytes(mode, srf.get_size(), pygame.image.tostring(srf, mode))
+    return PIL.Image.frombytes(mode, srf.get_size(), _tobytes(srf, mode))
 
 
 class Grabber: